@@ -27,6 +27,9 @@ export const API_METHODS = {
 	// filter methods
 	updateFilters: 'update_filters',
 
+	// applies several table, column & filter changes with a single save
+	batchMutate: 'batch_mutate',
+
 	addTransform: 'add_transform',
 	resetTransforms: 'reset_transforms',
 	getSourceSchema: 'get_source_schema',
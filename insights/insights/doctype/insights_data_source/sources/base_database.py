@@ -5,6 +5,9 @@ import frappe
 from sqlalchemy.sql import text
 from sqlalchemy.sql.elements import ClauseElement
 
+from insights.insights.doctype.insights_settings.insights_settings import (
+    get_allow_subquery,
+)
 from insights.insights.doctype.insights_table_import.insights_table_import import (
     InsightsTableImport,
 )
@@ -45,9 +48,7 @@ class BaseDatabase:
     def build_query(self, query, with_cte=False):
         """Build insights query and return the sql"""
         query_str = self.query_builder.build(query, dialect=self.engine.dialect)
-        if with_cte and frappe.db.get_single_value(
-            "Insights Settings", "allow_subquery"
-        ):
+        if with_cte and get_allow_subquery():
             query_str = replace_query_tables_with_cte(query_str, self.data_source)
         return query_str if query_str else None
 
@@ -56,7 +57,7 @@ class BaseDatabase:
         sql = self.build_query(query)
         if sql is None:
             return []
-        if frappe.db.get_single_value("Insights Settings", "allow_subquery"):
+        if get_allow_subquery():
             sql = replace_query_tables_with_cte(sql, self.data_source)
         # set a hard max limit to prevent long running queries
         max_rows = (
@@ -108,10 +109,7 @@ class BaseDatabase:
         return sql
 
     def process_subquery(self, sql, replace_query_tables):
-        allow_subquery = frappe.db.get_single_value(
-            "Insights Settings", "allow_subquery"
-        )
-        if replace_query_tables and allow_subquery:
+        if replace_query_tables and get_allow_subquery():
             sql = replace_query_tables_with_cte(sql, self.data_source)
         return sql
 
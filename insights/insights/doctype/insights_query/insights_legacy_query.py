@@ -1,8 +1,9 @@
 # Copyright (c) 2022, Frappe Technologies Pvt. Ltd. and contributors
 # For license information, please see license.txt
 
-from copy import deepcopy
-from json import dumps
+from inspect import signature
+from json import dumps, loads
+from typing import Final
 
 import frappe
 import pandas as pd
@@ -11,154 +12,245 @@ from frappe.utils.data import cstr
 from insights.api import fetch_column_values, get_tables
 
 from ..insights_data_source.sources.query_store import sync_query_store
+from ..insights_settings.insights_settings import get_allow_subquery
 from .utils import InsightsTable, get_columns_with_inferred_types
 
-DEFAULT_FILTERS = dumps(
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _dumps(obj, default=cstr):
+    if orjson is None:
+        return dumps(obj, default=default, indent=2)
+    return orjson.dumps(
+        obj,
+        default=default,
+        option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS,
+    ).decode()
+
+
+_loads = orjson.loads if orjson else loads
+
+
+def _parse(value):
+    if not isinstance(value, (str, bytes)):
+        return value
+    return _loads(value)
+
+
+DEFAULT_FILTERS: Final[str] = _dumps(
     {
         "type": "LogicalExpression",
         "operator": "&&",
         "level": 1,
         "position": 1,
         "conditions": [],
-    },
-    indent=2,
+    }
+)
+
+BATCH_MUTATIONS = (
+    "add_table",
+    "update_table",
+    "remove_table",
+    "add_column",
+    "move_column",
+    "update_column",
+    "remove_column",
+    "update_filters",
 )
 
+# beyond these sizes cumulative sums are computed with pandas
+CUMULATIVE_SUM_MAX_ROWS = 5000
+CUMULATIVE_SUM_MAX_COLUMNS = 10
+
 
 class InsightsLegacyQueryClient:
     @frappe.whitelist()
     def add_table(self, table):
-        new_table = {
-            "label": table.get("label"),
-            "table": table.get("table"),
-        }
-        self.append("tables", new_table)
+        self._add_table(table)
         self.save()
 
     @frappe.whitelist()
     def update_table(self, table):
-        for row in self.tables:
-            if row.get("name") != table.get("name"):
-                continue
-
-            if table.get("join"):
-                row.join = dumps(
-                    table.get("join"),
-                    default=cstr,
-                    indent=2,
-                )
-            else:
-                row.join = ""
-
+        if self._update_table(table):
             self.save()
-            return
 
     @frappe.whitelist()
     def remove_table(self, table):
-        for row in self.tables:
-            if row.get("name") == table.get("name"):
-                self.remove(row)
-                break
-
+        self._remove_table(table)
         self.save()
 
     @frappe.whitelist()
     def add_column(self, column):
-        new_column = {
-            "type": column.get("type"),
-            "label": column.get("label"),
-            "table": column.get("table"),
-            "column": column.get("column"),
-            "table_label": column.get("table_label"),
-            "aggregation": column.get("aggregation"),
-            "is_expression": column.get("is_expression"),
-            "expression": dumps(column.get("expression"), indent=2),
-            "format_option": dumps(column.get("format_option"), indent=2),
-        }
-        self.append("columns", new_column)
+        self._add_column(column)
         self.save()
 
     @frappe.whitelist()
     def move_column(self, from_index, to_index):
-        self.columns.insert(to_index, self.columns.pop(from_index))
-        for row in self.columns:
-            row.idx = self.columns.index(row) + 1
+        self._move_column(from_index, to_index)
         self.save()
 
     @frappe.whitelist()
     def update_column(self, column):
-        for row in self.columns:
-            if row.get("name") == column.get("name"):
-                row.type = column.get("type")
-                row.label = column.get("label")
-                row.table = column.get("table")
-                row.column = column.get("column")
-                row.order_by = column.get("order_by")
-                row.aggregation = column.get("aggregation")
-                row.table_label = column.get("table_label")
-                row.aggregation_condition = column.get("aggregation_condition")
-                format_option = column.get("format_option")
-                if format_option:
-                    # check if format option is an object
-                    row.format_option = (
-                        dumps(format_option, indent=2)
-                        if isinstance(format_option, dict)
-                        else format_option
-                    )
-                expression = column.get("expression")
-                if expression:
-                    # check if expression is an object
-                    row.expression = (
-                        dumps(expression, indent=2)
-                        if isinstance(expression, dict)
-                        else expression
-                    )
-                break
-
+        self._update_column(column)
         self.save()
 
     @frappe.whitelist()
     def remove_column(self, column):
-        for row in self.columns:
-            if row.get("name") == column.get("name"):
-                self.remove(row)
-                break
-
+        self._remove_column(column)
         self.save()
 
     @frappe.whitelist()
     def update_filters(self, filters):
+        self._update_filters(filters)
+        self.save()
+
+    @frappe.whitelist()
+    def batch_mutate(self, ops):
+        # applies multiple changes and saves the query only once
+        # ops: [{"op": "add_column", "payload": {"column": {...}}}, ...]
+        ops = _parse(ops)
+        if not isinstance(ops, list):
+            frappe.throw("Operations must be a list")
+        for op in ops:
+            if not isinstance(op, dict) or op.get("op") not in BATCH_MUTATIONS:
+                frappe.throw(f"Invalid operation {op}")
+            mutate = getattr(self, f"_{op['op']}")
+            payload = op.get("payload") or {}
+            if not isinstance(payload, dict) or set(payload) != set(
+                signature(mutate).parameters
+            ):
+                frappe.throw(f"Invalid payload for operation {op['op']}")
+            mutate(**payload)
+        self.save()
+
+    def _add_table(self, table):
+        new_table = {
+            "label": table.get("label"),
+            "table": table.get("table"),
+        }
+        self.append("tables", new_table)
+        self._clear_row_index("tables")
+
+    def _update_table(self, table):
+        row = self._get_row_by_name("tables", table.get("name"))
+        if not row:
+            return
+
+        if table.get("join"):
+            row.join = _dumps(table.get("join"))
+        else:
+            row.join = ""
+        return row
+
+    def _remove_table(self, table):
+        if row := self._get_row_by_name("tables", table.get("name")):
+            self.remove(row)
+            self._clear_row_index("tables")
+
+    def _add_column(self, column):
+        get = column.get
+        new_column = {
+            "type": get("type"),
+            "label": get("label"),
+            "table": get("table"),
+            "column": get("column"),
+            "table_label": get("table_label"),
+            "aggregation": get("aggregation"),
+            "is_expression": get("is_expression"),
+            "expression": _dumps(get("expression")),
+            "format_option": _dumps(get("format_option")),
+        }
+        self.append("columns", new_column)
+        self._clear_row_index("columns")
+
+    def _move_column(self, from_index, to_index):
+        self.columns.insert(to_index, self.columns.pop(from_index))
+        for idx, row in enumerate(self.columns, start=1):
+            row.idx = idx
+
+    def _update_column(self, column):
+        get = column.get
+        if row := self._get_row_by_name("columns", get("name")):
+            row.type = get("type")
+            row.label = get("label")
+            row.table = get("table")
+            row.column = get("column")
+            row.order_by = get("order_by")
+            row.aggregation = get("aggregation")
+            row.table_label = get("table_label")
+            row.aggregation_condition = get("aggregation_condition")
+            format_option = get("format_option")
+            if format_option:
+                # check if format option is an object
+                row.format_option = (
+                    _dumps(format_option)
+                    if isinstance(format_option, dict)
+                    else format_option
+                )
+            expression = get("expression")
+            if expression:
+                # check if expression is an object
+                row.expression = (
+                    _dumps(expression) if isinstance(expression, dict) else expression
+                )
+
+    def _remove_column(self, column):
+        if row := self._get_row_by_name("columns", column.get("name")):
+            self.remove(row)
+            self._clear_row_index("columns")
+
+    def _update_filters(self, filters):
         sanitized_conditions = self.sanitize_conditions(filters.get("conditions"))
         filters["conditions"] = sanitized_conditions or []
-        self.filters = dumps(filters, indent=2, default=cstr)
-        self.save()
+        self.filters = _dumps(filters)
+
+    def _get_row_by_name(self, child_table, name):
+        # index rows by name once per child table list instead of scanning it on
+        # every lookup; the index is rebuilt if the list object is replaced or on
+        # a miss, since new rows only get their name when the doc is saved
+        rows = self.get(child_table)
+        cache = self.get("_row_index_cache")
+        if cache is None:
+            cache = self._row_index_cache = {}
+        cached = cache.get(child_table)
+        if cached and cached[0] is rows and name in cached[1]:
+            return cached[1][name]
+        cached = (rows, {row.name: row for row in rows})
+        cache[child_table] = cached
+        return cached[1].get(name)
+
+    def _clear_row_index(self, child_table):
+        if cache := self.get("_row_index_cache"):
+            cache.pop(child_table, None)
 
     def sanitize_conditions(self, conditions):
         if not conditions:
             return
 
-        _conditions = deepcopy(conditions)
-
-        for idx, condition in enumerate(_conditions):
-            if "conditions" not in condition:
-                # TODO: validate if condition is valid
-                continue
-
-            sanitized_conditions = self.sanitize_conditions(condition.get("conditions"))
-            if sanitized_conditions:
-                conditions[idx]["conditions"] = sanitized_conditions
-            else:
-                # remove the condition if it has zero conditions
-                conditions.remove(condition)
+        # collect nested condition lists parent-first, then prune them
+        # children-first so that emptied groups cascade up to their parents
+        condition_lists = []
+        stack = [conditions]
+        while stack:
+            _conditions = stack.pop()
+            condition_lists.append(_conditions)
+            stack.extend(c["conditions"] for c in _conditions if c.get("conditions"))
+
+        for _conditions in reversed(condition_lists):
+            # TODO: validate if condition is valid
+            # remove the conditions that have zero conditions
+            _conditions[:] = [
+                c for c in _conditions if "conditions" not in c or c["conditions"]
+            ]
 
         return conditions
 
     @frappe.whitelist()
     def fetch_tables(self):
-        with_query_tables = frappe.db.get_single_value(
-            "Insights Settings", "allow_subquery"
-        )
-        return get_tables(self.data_source, with_query_tables)
+        return get_tables(self.data_source, get_allow_subquery())
 
     @frappe.whitelist()
     def fetch_columns(self):
@@ -175,36 +267,33 @@ class InsightsLegacyQueryClient:
 
     @frappe.whitelist()
     def fetch_join_options(self, left_table, right_table):
-        left_doc = frappe.get_cached_doc(
-            "Insights Table",
-            {
-                "table": left_table,
-                "data_source": self.data_source,
-            },
-        )
-        right_doc = frappe.get_cached_doc(
-            "Insights Table",
-            {
-                "table": right_table,
-                "data_source": self.data_source,
-            },
+        tables_columns_map = get_tables_columns_map(
+            self.data_source, [left_table, right_table]
         )
 
-        links = []
-        for link in left_doc.table_links:
-            if link.foreign_table == right_table:
-                links.append(
-                    frappe._dict(
-                        {
-                            "left": link.primary_key,
-                            "right": link.foreign_key,
-                        }
-                    )
-                )
+        Table = frappe.qb.DocType("Insights Table")
+        TableLink = frappe.qb.DocType("Insights Table Link")
+        table_links = (
+            frappe.qb.from_(Table)
+            .select(TableLink.primary_key, TableLink.foreign_key)
+            .join(TableLink)
+            .on(Table.name == TableLink.parent)
+            .where(
+                (Table.data_source == self.data_source)
+                & (Table.table == left_table)
+                & (TableLink.foreign_table == right_table)
+            )
+            .orderby(TableLink.idx)
+            .run(as_dict=True)
+        )
+        links = [
+            {"left": link.primary_key, "right": link.foreign_key}
+            for link in table_links
+        ]
 
         return {
-            "left_columns": left_doc.get_columns(),
-            "right_columns": right_doc.get_columns(),
+            "left_columns": tables_columns_map[left_table],
+            "right_columns": tables_columns_map[right_table],
             "saved_links": links,
         }
 
@@ -218,12 +307,20 @@ class InsightsLegacyQueryValidation:
 
     def validate_tables(self):
         tables = [row.table for row in self.doc.tables]
-        tables = frappe.get_all(
+        if not tables:
+            return
+        # only fetch the first table that is not allowed to be queried
+        invalid_tables = frappe.get_all(
             "Insights Table",
             filters={"name": ("in", tables)},
+            or_filters={
+                "hidden": 1,
+                "data_source": ("!=", self.doc.data_source),
+            },
             fields=["table", "data_source", "hidden"],
+            limit=1,
         )
-        for table in tables:
+        for table in invalid_tables:
             if table.hidden:
                 frappe.throw(f"Table {table.table} is hidden. You cannot query it")
             if table.data_source != self.doc.data_source:
@@ -235,17 +332,19 @@ class InsightsLegacyQueryValidation:
 
     def validate_filters(self):
         if not self.doc.filters:
-            self.filters = DEFAULT_FILTERS
+            self.doc.filters = DEFAULT_FILTERS
 
     def validate_columns(self):
         if frappe.flags.in_test:
             return
         # check if no duplicate labelled columns
-        labels = []
+        labels = set()
         for row in self.doc.columns:
-            if row.label and row.label in labels:
+            if not row.label:
+                continue
+            if row.label in labels:
                 frappe.throw(f"Duplicate Column {row.label}")
-            labels.append(row.label)
+            labels.add(row.label)
 
 
 class InsightsLegacyQueryController(InsightsLegacyQueryValidation):
@@ -266,61 +365,78 @@ class InsightsLegacyQueryController(InsightsLegacyQueryValidation):
             return []
 
         query_columns = self.doc.columns
-        inferred_column_types = get_columns_with_inferred_types(results)
         if not query_columns:
-            return inferred_column_types
-
-        def get_inferred_column_type(result_column):
-            for ic in inferred_column_types:
-                if ic.get("label") == result_column.get("label"):
-                    return ic.get("type")
-            return "String"
-
-        def add_format_options(result_column):
-            result_column["format_options"] = {}
-            result_column["type"] = get_inferred_column_type(result_column)
-            for qc in query_columns:
-                label_matches = qc.get("label") == result_column.get("label")
-                column_matches = qc.get("column") == result_column.get("label")
-                if not label_matches and not column_matches:
-                    continue
-                result_column["format_options"] = qc.get("format_option")
-                result_column["type"] = qc.get("type")
-                break
-            return frappe._dict(result_column)
+            return get_columns_with_inferred_types(results)
+
+        # map both labels and column names to the first query column that has them
+        query_columns_map = {}
+        for qc in reversed(query_columns):
+            if qc.get("column"):
+                query_columns_map[qc.get("column")] = qc
+            if qc.get("label"):
+                query_columns_map[qc.get("label")] = qc
 
         result_columns = results[0]
-        return [add_format_options(rc) for rc in result_columns]
+        # only infer types of the result columns without a matching query column
+        unmatched = [
+            idx
+            for idx, rc in enumerate(result_columns)
+            if rc.get("label") not in query_columns_map
+        ]
+        inferred_types = {}
+        if unmatched:
+            unmatched_results = [[result_columns[idx] for idx in unmatched]] + [
+                [row[idx] for idx in unmatched] for row in results[1:]
+            ]
+            inferred_types = {
+                ic.get("label"): ic.get("type")
+                for ic in get_columns_with_inferred_types(unmatched_results)
+            }
+
+        columns = []
+        for result_column in result_columns:
+            label = result_column.get("label")
+            if qc := query_columns_map.get(label):
+                result_column["format_options"] = qc.get("format_option")
+                result_column["type"] = qc.get("type")
+            else:
+                result_column["format_options"] = {}
+                result_column["type"] = inferred_types.get(label) or "String"
+            columns.append(frappe._dict(result_column))
+        return columns
 
     def get_tables_columns(self):
+        if not self.doc.tables:
+            return []
+
         columns = []
         selected_tables = self.get_selected_tables()
+        tables_columns_map = get_tables_columns_map(
+            self.doc.data_source, [table.table for table in selected_tables]
+        )
         for table in selected_tables:
-            table_doc = InsightsTable.get_doc(
-                data_source=self.doc.data_source,
-                table=table.table,
-            )
-            table_columns = table_doc.get_columns()
+            table_columns = tables_columns_map[table.table]
             columns += [
-                frappe._dict(
-                    {
-                        "data_source": self.doc.data_source,
-                        "table_label": table.get("label"),
-                        "table": table.get("table"),
-                        "column": c.get("column"),
-                        "label": c.get("label"),
-                        "type": c.get("type"),
-                    }
-                )
+                {
+                    "data_source": self.doc.data_source,
+                    "table_label": table.get("label"),
+                    "table": table.get("table"),
+                    "column": c.get("column"),
+                    "label": c.get("label"),
+                    "type": c.get("type"),
+                }
                 for c in table_columns
             ]
         return columns
 
     def get_selected_tables(self):
+        if not self.doc.tables:
+            return []
+
         join_tables = []
         for table in self.doc.tables:
             if table.join:
-                join = frappe.parse_json(table.join)
+                join = self.get_parsed_join(table)
                 join_tables.append(
                     frappe._dict(
                         table=join.get("with").get("value"),
@@ -330,6 +446,14 @@ class InsightsLegacyQueryController(InsightsLegacyQueryValidation):
 
         return self.doc.tables + join_tables
 
+    def get_parsed_join(self, table):
+        # parse the join once per table row and again only if it has changed
+        parsed_join = table.get("_parsed_join")
+        if not parsed_join or parsed_join[0] != table.join:
+            parsed_join = (table.join, _parse(table.join))
+            table._parsed_join = parsed_join
+        return parsed_join[1]
+
     def before_fetch(self):
         if self.doc.data_source != "Query Store":
             return
@@ -339,22 +463,71 @@ class InsightsLegacyQueryController(InsightsLegacyQueryValidation):
         sync_query_store(sub_stored_queries, force=True)
 
     def after_fetch_results(self, results):
-        if self.has_cumulative_columns():
-            results = self.apply_cumulative_sum(results)
+        if cumulative_columns := self.get_cumulative_columns():
+            results = self.apply_cumulative_sum(results, cumulative_columns)
         return results
 
-    def has_cumulative_columns(self):
-        return any(
-            col.aggregation and "Cumulative" in col.aggregation
+    def get_cumulative_columns(self):
+        return [
+            col.label
             for col in self.doc.columns
-        )
+            if col.aggregation and col.aggregation.startswith("Cumulative")
+        ]
 
-    def apply_cumulative_sum(self, results):
+    def apply_cumulative_sum(self, results, cumulative_columns):
         column_names = [d["label"] for d in results[0]]
-        results_df = pd.DataFrame(results[1:], columns=column_names)
-
-        for column in self.doc.columns:
-            if "Cumulative" in column.aggregation:
-                results_df[column.label] = results_df[column.label].cumsum()
-
-        return [results[0]] + results_df.values.tolist()
+        # both paths treat NULL as 0 and carry the running total into NULL rows
+        if (
+            len(results) - 1 > CUMULATIVE_SUM_MAX_ROWS
+            or len(cumulative_columns) > CUMULATIVE_SUM_MAX_COLUMNS
+        ):
+            results_df = pd.DataFrame(results[1:], columns=column_names)
+            results_df[cumulative_columns] = (
+                results_df[cumulative_columns].fillna(0).cumsum()
+            )
+            return [results[0]] + results_df.to_numpy().tolist()
+
+        # small result sets are cheaper to sum up without building a dataframe
+        indexes = [column_names.index(label) for label in cumulative_columns]
+        running_totals = [0] * len(indexes)
+        rows = []
+        for row in results[1:]:
+            row = list(row)
+            for i, idx in enumerate(indexes):
+                running_totals[i] += row[idx] or 0
+                row[idx] = running_totals[i]
+            rows.append(row)
+        return [results[0]] + rows
+
+
+def get_tables_columns_map(data_source, tables):
+    """Returns the columns of the given tables in a single query, keyed by table"""
+    if not tables:
+        return {}
+
+    Table = frappe.qb.DocType("Insights Table")
+    TableColumn = frappe.qb.DocType("Insights Table Column")
+    tables_columns = (
+        frappe.qb.from_(Table)
+        .select(
+            Table.table,
+            TableColumn.column,
+            TableColumn.label,
+            TableColumn.type,
+        )
+        .join(TableColumn)
+        .on(Table.name == TableColumn.parent)
+        .where((Table.data_source == data_source) & (Table.table.isin(tables)))
+        .orderby(TableColumn.idx)
+        .run(as_dict=True)
+    )
+    tables_columns_map = {}
+    for column in tables_columns:
+        tables_columns_map.setdefault(column.table, []).append(column)
+
+    for table in tables:
+        if not tables_columns_map.get(table):
+            # columns are not synced yet, let the table doc fetch them
+            table_doc = InsightsTable.get_doc(data_source=data_source, table=table)
+            tables_columns_map[table] = table_doc.get_columns()
+    return tables_columns_map
@@ -2,6 +2,7 @@
 # See license.txt
 
 import json
+from unittest.mock import patch
 
 import frappe
 from frappe.tests.utils import FrappeTestCase
@@ -9,6 +10,8 @@ from frappe.utils import random_string
 
 from insights.api import fetch_column_values
 
+from .insights_legacy_query import InsightsLegacyQueryController
+
 test_dependencies = ("Insights Data Source", "Insights Table")
 test_records = frappe.get_test_records("Insights Query")
 
@@ -136,6 +139,141 @@ class TestInsightsQuery(FrappeTestCase):
         self.assertEqual(len(result), 11)
         self.assertEqual(result[-1][2], 10)
 
+    def test_sanitize_nested_conditions(self):
+        condition = {
+            "type": "BinaryExpression",
+            "operator": "=",
+            "left": make_todo_column("status"),
+            "right": make_string("Open"),
+        }
+        # nest an empty group deeper than the recursion limit
+        empty_group = {"type": "LogicalExpression", "conditions": []}
+        for _ in range(2000):
+            empty_group = {"type": "LogicalExpression", "conditions": [empty_group]}
+        group = {"type": "LogicalExpression", "conditions": [condition, empty_group]}
+
+        query = frappe.new_doc("Insights Query")
+        conditions = query.sanitize_conditions([condition, group, empty_group])
+        self.assertEqual(len(conditions), 2)
+        self.assertEqual(conditions[0], condition)
+        self.assertEqual(conditions[1]["conditions"], [condition])
+
+    def test_cumulative_sum_with_nulls(self):
+        query = frappe.new_doc("Insights Query")
+        query.append(
+            "columns",
+            {"label": "Cumulative Sum", "aggregation": "Cumulative Sum"},
+        )
+        controller = InsightsLegacyQueryController(query)
+        results = [
+            [{"label": "Day"}, {"label": "Cumulative Sum"}],
+            ["Mon", 1],
+            ["Tue", None],
+            ["Wed", 2],
+            ["Thu", None],
+        ]
+        expected = [1, 1, 3, 3]
+
+        # small result sets are summed without pandas
+        summed = controller.apply_cumulative_sum(results, ["Cumulative Sum"])
+        self.assertEqual([row[1] for row in summed[1:]], expected)
+
+        # larger result sets fall back to pandas and must give the same sums
+        with patch(
+            "insights.insights.doctype.insights_query.insights_legacy_query"
+            ".CUMULATIVE_SUM_MAX_ROWS",
+            2,
+        ):
+            summed = controller.apply_cumulative_sum(results, ["Cumulative Sum"])
+        self.assertEqual([row[1] for row in summed[1:]], expected)
+
+    def test_batch_mutate(self):
+        query = frappe.get_doc(test_records[2])
+        query.data_source = self.data_source
+        query.save()
+
+        filters = json.loads(query.filters)
+        filters["conditions"] = [
+            {
+                "type": "BinaryExpression",
+                "operator": "=",
+                "left": make_todo_column("status"),
+                "right": make_string("Open"),
+            }
+        ]
+        ops = [
+            {
+                "op": "add_column",
+                "payload": {
+                    "column": {
+                        "label": "Status",
+                        "column": "status",
+                        "type": "String",
+                        "table": "tabToDo",
+                        "table_label": "ToDo",
+                        "aggregation": "Group By",
+                    }
+                },
+            },
+            {"op": "update_filters", "payload": {"filters": filters}},
+            {"op": "move_column", "payload": {"from_index": 1, "to_index": 0}},
+        ]
+        with patch.object(query, "save", wraps=query.save) as save:
+            query.batch_mutate(ops)
+        self.assertEqual(save.call_count, 1)
+
+        query.reload()
+        self.assertEqual([c.label for c in query.columns], ["Status", "Name"])
+        self.assertEqual(len(json.loads(query.filters)["conditions"]), 1)
+
+        invalid_ops = [
+            [{"op": "delete", "payload": {}}],
+            ["add_column"],
+            [{"op": "add_column", "payload": {"column": {}, "_defer_save": True}}],
+        ]
+        for ops in invalid_ops:
+            self.assertRaises(frappe.ValidationError, query.batch_mutate, ops)
+
+    def test_columns_from_results(self):
+        query = frappe.new_doc("Insights Query")
+        query.append(
+            "columns",
+            {
+                "label": "Total",
+                "column": "amount",
+                "type": "Decimal",
+                "format_option": '{"prefix": "$"}',
+            },
+        )
+        # its label matches the first column's name, the first column must win
+        query.append(
+            "columns", {"label": "amount", "column": "other", "type": "Integer"}
+        )
+        query.append("columns", {"label": "Untyped", "column": "untyped"})
+        controller = InsightsLegacyQueryController(query)
+
+        results = [
+            [
+                {"label": "name"},
+                {"label": "amount"},
+                {"label": "qty"},
+                {"label": "Untyped"},
+            ],
+            ["a", 1.5, 2, "x"],
+            ["b", 2.5, 3, "y"],
+        ]
+        columns = controller.get_columns_from_results(results)
+        columns = {c.label: c for c in columns}
+
+        self.assertEqual(columns["amount"].type, "Decimal")
+        self.assertEqual(columns["amount"].format_options, '{"prefix": "$"}')
+        # unmatched columns get the types inferred from their own values
+        self.assertEqual(columns["name"].type, "String")
+        self.assertEqual(columns["qty"].type, "Integer")
+        self.assertEqual(columns["qty"].format_options, {})
+        # a matched query column without a type still overrides the inferred type
+        self.assertIsNone(columns["Untyped"].type)
+
 
 class TestInsightsQueryBuilder(FrappeTestCase):
     def __init__(self, *args, **kwargs):
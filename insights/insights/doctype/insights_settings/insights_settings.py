@@ -8,8 +8,13 @@ from insights import notify
 from insights.api.subscription import get_subscription_key
 from insights.decorators import check_role
 
+ALLOW_SUBQUERY_CACHE_KEY = "insights_allow_subquery"
+
 
 class InsightsSettings(Document):
+    def on_change(self):
+        frappe.cache().delete_value(ALLOW_SUBQUERY_CACHE_KEY)
+
     @frappe.whitelist()
     def update_settings(self, settings):
         settings = frappe.parse_json(settings)
@@ -63,3 +68,13 @@ class InsightsSettings(Document):
                 message="Error sending login link to your email",
                 type="error",
             )
+
+
+def get_allow_subquery():
+    # cached in redis so that every worker sees the change once the settings are saved
+    return frappe.cache().get_value(
+        ALLOW_SUBQUERY_CACHE_KEY,
+        generator=lambda: frappe.db.get_single_value(
+            "Insights Settings", "allow_subquery"
+        ),
+    )